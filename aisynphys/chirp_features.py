@@ -0,0 +1,134 @@
+# coding: utf8
+"""
+Chirp (impedance amplitude profile) feature extraction.
+
+This is a local stand-in for ipfx.chirp_features.extract_chirp_fft built on
+scipy.fft: the real-input rfft does half the work of the full complex FFT and
+returns only the nonnegative-frequency bins, and sweeps are padded to a
+5-smooth length with next_fast_len so odd-length chirps never fall back to the
+slow Bluestein transform.
+"""
+import numpy as np
+import scipy.fft
+
+from neuroanalysis.util.optional_import import optional_import
+FeatureError = optional_import('ipfx.error', 'FeatureError')
+
+
+def extract_chirp_fft(sweep_set, min_freq=0.2, max_freq=40.):
+    """Calculate impedance amplitude profile features from a set of chirp sweeps.
+
+    Sweep voltages are in mV and currents in pA, so impedance values are in MOhm.
+
+    Parameters
+    ----------
+    sweep_set : ipfx.sweep.SweepSet
+        Chirp sweeps to analyze.
+    min_freq : float
+        Low end of the analyzed frequency range (Hz).
+    max_freq : float
+        High end of the analyzed frequency range (Hz).
+
+    Returns
+    -------
+    features : dict
+        Keys: peak_freq, peak_impedance, peak_ratio, 3db_freq, sync_freq,
+        total_inductive_phase.
+    """
+    amps = []
+    phases = []
+    freq = None
+    for sweep in sweep_set.sweeps:
+        amp, phase, swp_freq = _transform_sweep(sweep, min_freq, max_freq)
+        if freq is None:
+            freq = swp_freq
+        else:
+            # sweeps of different lengths land on different frequency grids;
+            # resample onto the grid of the first sweep before averaging
+            amp = np.interp(freq, swp_freq, amp)
+            phase = np.interp(freq, swp_freq, phase)
+        amps.append(amp)
+        phases.append(phase)
+
+    if len(amps) == 0:
+        raise FeatureError('No chirp sweeps available for analysis')
+
+    avg_amp = np.vstack(amps).mean(axis=0)
+    avg_phase = np.vstack(phases).mean(axis=0)
+
+    i_peak = np.argmax(avg_amp)
+    peak_impedance = avg_amp[i_peak]
+    peak_freq = freq[i_peak]
+    # resonance expressed relative to the low-frequency impedance
+    peak_ratio = peak_impedance / avg_amp[0]
+
+    # highest frequency at which impedance is within 3 dB of the peak
+    above_3db = np.flatnonzero(avg_amp >= peak_impedance / np.sqrt(2))
+    freq_3db = freq[above_3db[-1]]
+
+    # synchronization frequency: where the phase first crosses zero
+    nonpos = np.flatnonzero(avg_phase <= 0)
+    sync_freq = freq[nonpos[0]] if len(nonpos) > 0 else freq[-1]
+
+    # total inductive area: integral of the positive (leading) phase
+    inductive = avg_phase > 0
+    if inductive.any():
+        total_inductive_phase = np.trapz(avg_phase[inductive], freq[inductive])
+    else:
+        total_inductive_phase = 0.0
+
+    return {
+        'peak_freq': peak_freq,
+        'peak_impedance': peak_impedance,
+        'peak_ratio': peak_ratio,
+        '3db_freq': freq_3db,
+        'sync_freq': sync_freq,
+        'total_inductive_phase': total_inductive_phase,
+    }
+
+
+# cache of stimulus spectra: every sweep of a chirp protocol -- and every cell
+# in an experiment -- replays the same command waveform, so they share one
+# stimulus FFT. The key includes a fingerprint of the waveform bytes (like
+# ipfx's hash(swp.i.data.tobytes()) sweep keys) so that chirp variants with
+# the same rate and length cannot collide
+_stim_fft_cache = {}
+_STIM_FFT_CACHE_SIZE = 8
+
+
+def _chirp_stim_fft(i, sample_rate, nfft):
+    """Return the rfft of the mean-subtracted chirp stimulus trace *i*,
+    reusing the cached spectrum for this exact waveform if available.
+    """
+    key = (sample_rate, nfft, hash(i.tobytes()))
+    fft = _stim_fft_cache.get(key)
+    if fft is None:
+        fft = scipy.fft.rfft(i - i.mean(), n=nfft, workers=-1)
+        fft.setflags(write=False)
+        if len(_stim_fft_cache) >= _STIM_FFT_CACHE_SIZE:
+            _stim_fft_cache.pop(next(iter(_stim_fft_cache)))
+        _stim_fft_cache[key] = fft
+    return fft
+
+
+def _transform_sweep(sweep, min_freq, max_freq):
+    """Return (impedance amplitude, impedance phase, frequency) for one chirp sweep,
+    restricted to [min_freq, max_freq].
+    """
+    v = sweep.v
+    i = sweep.i
+    if len(v) == 0:
+        raise FeatureError('Chirp sweep contains no data')
+
+    # pad to a 5-smooth length; rfft returns the n//2+1 nonnegative-frequency bins
+    nfft = scipy.fft.next_fast_len(len(v))
+    v_fft = scipy.fft.rfft(v - v.mean(), n=nfft, workers=-1)
+    i_fft = _chirp_stim_fft(i, sweep.sampling_rate, nfft)
+    freq = scipy.fft.rfftfreq(nfft, d=1.0 / sweep.sampling_rate)
+
+    mask = (freq >= min_freq) & (freq <= max_freq)
+    if not mask.any():
+        raise FeatureError('Chirp sweep has no frequency samples in [%g, %g] Hz' % (min_freq, max_freq))
+
+    z = v_fft[mask] / i_fft[mask]  # mV / pA = MOhm
+    return np.abs(z), np.angle(z), freq[mask]
@@ -28,6 +28,18 @@ synphys_db_readonly_user = "readonly"  # readonly postgres username assigned whr
 lims_address = None
 rig_name = None
 n_headstages = 8
+# Parallel feature extraction within a single pipeline job (see
+# aisynphys.pipeline.multipatch.intrinsic). If False, cells are processed serially.
+# n_workers=None uses one worker per CPU core.
+parallel_intrinsic = False
+parallel_synapse_fits = False
+n_workers = None
+# If True and numba is installed, patch numba-compiled kernels into
+# ipfx.spike_detector (see aisynphys.spike_jit).
+jit_spike_detection = False
+# If set (Hz), intrinsic sweeps sampled faster than this are polyphase-decimated
+# before feature extraction; None analyzes at the acquired rate.
+intrinsic_target_sample_rate = None
 rig_data_paths = {}
 known_addrs = {}
 
@@ -1,5 +1,5 @@
 import datetime
-from sqlalchemy.orm import aliased, contains_eager, selectinload
+from sqlalchemy.orm import aliased, contains_eager, selectinload, joinedload
 from collections import OrderedDict
 from .database import Database
 from .schema import schema_version, default_sample_rate
@@ -119,9 +119,24 @@ class SynphysDatabase(Database):
         
         return expts[0]
 
-    def experiment_from_ext_id(self, ext_id, session=None):
+    def experiment_from_ext_id(self, ext_id, session=None, preload=()):
+        """Return the experiment with the given ext_id.
+
+        *preload* optionally lists resources to eager-load in the same query so
+        that iterating them later does not fire one lazy load per row:
+        'cells' loads Experiment.cell_list along with each cell's electrode;
+        'pairs' loads Experiment.pair_list along with each pair's pre/post cell.
+        """
         session = session or self.default_session
-        expts = session.query(self.Experiment).filter(self.Experiment.ext_id==ext_id).all()
+        query = session.query(self.Experiment).filter(self.Experiment.ext_id==ext_id)
+        if 'cells' in preload:
+            query = query.options(joinedload(self.Experiment.cell_list).joinedload(self.Cell.electrode))
+        if 'pairs' in preload:
+            query = query.options(
+                joinedload(self.Experiment.pair_list).joinedload(self.Pair.pre_cell),
+                joinedload(self.Experiment.pair_list).joinedload(self.Pair.post_cell),
+            )
+        expts = query.all()
         if len(expts) == 0:
             raise KeyError('No experiment found for ext_id %s' %ext_id)
         elif len(expts) > 1:
@@ -5,22 +5,34 @@ For generating a table that describes cell intrinisic properties
 """
 from __future__ import print_function, division
 
-import traceback, sys, logging
-import numpy as np   
+import traceback, sys, logging, multiprocessing, threading, queue, collections, weakref
+from concurrent.futures import ProcessPoolExecutor
+from fractions import Fraction
+import numpy as np
+import scipy.signal
 
 from neuroanalysis.util.optional_import import optional_import
 extractors_for_sweeps = optional_import('ipfx.data_set_features', 'extractors_for_sweeps')
 LongSquareAnalysis = optional_import('ipfx.stimulus_protocol_analysis', 'LongSquareAnalysis')
 Sweep, SweepSet = optional_import('ipfx.sweep', ['Sweep', 'SweepSet'])
 FeatureError = optional_import('ipfx.error', 'FeatureError')
-extract_chirp_fft = optional_import('ipfx.chirp_features', 'extract_chirp_fft')
+extract_chirp_fft = optional_import('aisynphys.chirp_features', 'extract_chirp_fft')
 get_complete_long_square_features = optional_import('ipfx.bin.features_from_output_json', 'get_complete_long_square_features')
 
 from .pipeline_module import MultipatchPipelineModule
 from .experiment import ExperimentPipelineModule
 from .dataset import DatasetPipelineModule
+from ... import config
 from ...nwb_recordings import get_intrinsic_recording_dict, get_pulse_times
 
+if config.jit_spike_detection:
+    try:
+        from ...spike_jit import install as _install_spike_jit
+        _install_spike_jit()
+    except ImportError:
+        # numba (or ipfx) not available; stock ipfx spike detection is used
+        pass
+
 
 SPIKE_FEATURES = [
     'upstroke_downstroke_ratio',
@@ -44,8 +56,9 @@ class IntrinsicPipelineModule(MultipatchPipelineModule):
         db = job['database']
         job_id = job['job_id']
 
-        # Load experiment from DB
-        expt = db.experiment_from_ext_id(job_id, session=session)
+        # Load experiment from DB, with the cell/electrode graph eager-loaded
+        # so the per-cell loop below does not fire one query per attribute
+        expt = db.experiment_from_ext_id(job_id, session=session, preload=['cells'])
         try:
             assert expt.data is not None
             # this should catch corrupt NWBs
@@ -54,35 +67,99 @@ class IntrinsicPipelineModule(MultipatchPipelineModule):
             error = 'No NWB data for this experiment'
             return [error]
 
-        n_cells = len(expt.cell_list)
-        errors = []
-        for cell in expt.cell_list:
+        # submit the cells with the most data first so that stragglers don't
+        # hold up the end of a parallel run
+        sweeps = expt.data.contents
+        def n_sweeps(cell):
             dev_id = cell.electrode.device_id
-            recording_dict = get_intrinsic_recording_dict(expt, dev_id, check_qc=True)
-            
-            lp_results, error = IntrinsicPipelineModule.get_long_square_features(recording_dict['LP'], cell_id=cell.id)
-            errors += error
-            chirp_results, error = IntrinsicPipelineModule.get_chirp_features(recording_dict['Chirp'], cell_id=cell.id)
-            errors += error
-            # Write new record to DB
-            conn = db.Intrinsic(cell_id=cell.id, **lp_results, **chirp_results)
-            session.add(conn)
+            return sum(1 for sweep in sweeps if dev_id in sweep.devices)
+        cells = sorted(expt.cell_list, key=n_sweeps, reverse=True)
+
+        errors = []
+        rows = []
+
+        # skip cells whose electrodes have no qc-passed current clamp recordings
+        # before doing any NWB parsing; their sweeps would all be discarded by
+        # the qc check in get_intrinsic_recording_dict anyway
+        qc_cells = []
+        for cell in cells:
+            if _has_qc_passed_recordings(session, db, cell):
+                qc_cells.append(cell)
+            else:
+                errors.append('No qc-passed recordings for cell %s' % cell.id)
+                rows.append(db.Intrinsic(cell_id=cell.id))
+        cells = qc_cells
+
+        # daemonic pool workers (the framework's parallel mode) cannot spawn
+        # child processes of their own, so fall back to the threaded path there
+        parallel = (config.parallel_intrinsic and len(cells) > 1
+                    and not multiprocessing.current_process().daemon)
+        if parallel:
+            # per-cell feature extraction is CPU-bound and independent, so cells are
+            # dispatched to worker processes; each worker re-opens the experiment NWB.
+            # DB writes stay on this thread because sessions cannot be shared across processes.
+            # The db itself can't cross the process boundary (engines hold locks and
+            # sockets), so workers get its class and addresses and rebuild it.
+            db_desc = (type(db), db.ro_host, db.rw_host, db.db_name)
+            ctx = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=config.n_workers, mp_context=ctx) as pool:
+                futures = [(cell, pool.submit(_extract_cell_intrinsic, db_desc, job_id, cell.ext_id)) for cell in cells]
+                for cell, fut in futures:
+                    lp_results, chirp_results, error = fut.result()
+                    errors += error
+                    rows.append(db.Intrinsic(cell_id=cell.id, **lp_results, **chirp_results))
+        else:
+            # pipeline feature extraction with DB writes: a worker thread computes
+            # features for cell N+1 while the main thread adds cell N's record to
+            # the session; the bounded queue keeps memory use in check
+            results = queue.Queue(maxsize=4)
+            stop = threading.Event()
+            def extract_worker():
+                for cell in cells:
+                    if stop.is_set():
+                        break
+                    try:
+                        results.put((cell, _cell_intrinsic_features(expt, cell), None))
+                    except Exception:
+                        # the main thread re-raises this; don't keep computing
+                        # (and holding NWB handles) for results nobody will read
+                        results.put((cell, None, sys.exc_info()))
+                        break
+            worker = threading.Thread(target=extract_worker, daemon=True)
+            worker.start()
+            try:
+                for _ in cells:
+                    cell, result, exc_info = results.get()
+                    if exc_info is not None:
+                        raise exc_info[1].with_traceback(exc_info[2])
+                    lp_results, chirp_results, error = result
+                    errors += error
+                    rows.append(db.Intrinsic(cell_id=cell.id, **lp_results, **chirp_results))
+            finally:
+                stop.set()
+                # free queue space in case the worker is blocked in put(), then reap it
+                while not results.empty():
+                    results.get()
+                worker.join()
+
+        # write all new records in one batched INSERT rather than one flush
+        # round-trip per cell; nothing downstream needs the autogenerated PKs
+        session.bulk_save_objects(rows, return_defaults=False)
 
         return errors
 
     @staticmethod
-    def get_chirp_features(recordings, cell_id=''):
+    def get_chirp_features(recordings, cell_id='', sweeps=None):
         errors = []
         if len(recordings) == 0:
             errors.append('No chirp sweeps for cell %s' % cell_id)
             return {}, errors
-             
-        sweep_list = []
-        for rec in recordings:
-            sweep = MPSweep(rec)
-            if sweep is not None:
-                sweep_list.append(sweep)
-        
+
+        if sweeps is None:
+            _, sweeps, _, build_errors = _build_intrinsic_sweeps({'LP': [], 'Chirp': recordings}, cell_id=cell_id)
+            errors += build_errors
+        sweep_list = sweeps
+
         if len(sweep_list) == 0:
             errors.append('No chirp sweeps passed qc for cell %s' % cell_id)
             return {}, errors
@@ -106,36 +183,52 @@ class IntrinsicPipelineModule(MultipatchPipelineModule):
             logging.exception(f'Error processing chirps for cell {cell_id}')
             errors.append('Error processing chirps for cell %s: %s' % (cell_id, str(exc)))
             results = {}
-        
+        finally:
+            # only scalar features survive this point, so the sweep arrays can
+            # be recycled
+            for sweep in sweep_list:
+                sweep.release()
+
         return results, errors
 
     @staticmethod
-    def get_long_square_features(recordings, cell_id=''):
+    def get_long_square_features(recordings, cell_id='', sweeps=None, min_pulse_dur=None):
         errors = []
         if len(recordings) == 0:
             errors.append('No long pulse sweeps for cell %s' % cell_id)
             return {}, errors
 
-        min_pulse_dur = np.inf
-        sweep_list = []
-        for rec in recordings:
-            pulse_times = get_pulse_times(rec)
-            if pulse_times is None:
-                continue
-            
-            # pulses may have different durations as well, so we just use the smallest duration
-            start, end = pulse_times
-            min_pulse_dur = min(min_pulse_dur, end-start)
-            
-            sweep = MPSweep(rec, -start)
-            if sweep is not None:
-                sweep_list.append(sweep)
-        
+        if sweeps is None:
+            sweeps, _, min_pulse_dur, build_errors = _build_intrinsic_sweeps({'LP': recordings, 'Chirp': []}, cell_id=cell_id)
+            errors += build_errors
+        if min_pulse_dur is None:
+            # no usable pulse stimuli; the sweep builder recorded the reason
+            return {}, errors
+        sweep_list = sweeps
+
         if len(sweep_list) == 0:
             errors.append('No long square sweeps passed qc for cell %s' % cell_id)
             return {}, errors
 
-        sweep_set = SweepSet(sweep_list)    
+        # stack sweeps into 2-D arrays so that batch QC runs as vectorized
+        # reductions rather than per-sweep Python loops; a single sweep with
+        # non-finite samples would otherwise fail the entire ipfx analysis
+        batch = _SweepBatch(sweep_list)
+        qc_mask = batch.qc_mask()
+        if not qc_mask.all():
+            errors.append('%d long square sweeps with non-finite data dropped for cell %s' % (int((~qc_mask).sum()), cell_id))
+            kept = []
+            for sweep, ok in zip(sweep_list, qc_mask):
+                if ok:
+                    kept.append(sweep)
+                else:
+                    sweep.release()
+            sweep_list = kept
+            if len(sweep_list) == 0:
+                errors.append('No long square sweeps passed qc for cell %s' % cell_id)
+                return {}, errors
+
+        sweep_set = SweepSet(sweep_list)
         spx, spfx = extractors_for_sweeps(sweep_set, start=0, end=min_pulse_dur)
         lsa = LongSquareAnalysis(spx, spfx, subthresh_min_amp=-200)
         
@@ -143,14 +236,20 @@ class IntrinsicPipelineModule(MultipatchPipelineModule):
             analysis = lsa.analyze(sweep_set)
         except Exception as exc:
             errors.append('Error running long square analysis for cell %s: %s' % (cell_id, str(exc)))
+            for sweep in sweep_list:
+                sweep.release()
             return {}, errors
-        
+
         analysis_dict = lsa.as_dict(analysis)
-        output = get_complete_long_square_features(analysis_dict) 
-        avg_rate = np.mean(analysis['spiking_sweeps'].avg_rate)
-        
+        output = get_complete_long_square_features(analysis_dict)
+        # guard against accidental mutation of arrays that ipfx may share
+        # between analysis products
+        for value in output.values():
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+
         results = {
-            'avg_firing_rate': avg_rate,
+            'avg_firing_rate': np.mean(analysis['spiking_sweeps'].avg_rate),
             'rheobase': output['rheobase_i'] * 1e-12, #unscale from pA,
             'fi_slope': output['fi_fit_slope'] * 1e-12, #unscale from pA,
             'input_resistance': output['input_resistance'] * 1e6, #unscale from MOhm,
@@ -172,6 +271,9 @@ class IntrinsicPipelineModule(MultipatchPipelineModule):
             'width_adapt_ratio': output['width_adapt_ratio'],
             'threshold_v_adapt_ratio': output['threshold_v_adapt_ratio'],
         }
+        # only scalar features survive this point, so the sweep arrays can be recycled
+        for sweep in sweep_list:
+            sweep.release()
         return results, errors
 
     def job_records(self, job_ids, session):
@@ -186,28 +288,270 @@ class IntrinsicPipelineModule(MultipatchPipelineModule):
         q = q.filter(db.Experiment.ext_id.in_(job_ids))
         return q.all()
 
+
+class _SweepBatch(object):
+    """Structure-of-arrays view of a list of sweeps.
+
+    Voltage and current are stacked into 2-D (n_sweeps, n_samples) arrays with
+    shorter sweeps padded by NaN, so per-sweep statistics can be computed as
+    single vectorized reductions instead of one Python pass per sweep object.
+    """
+    def __init__(self, sweeps):
+        self.sweeps = sweeps
+        self.lengths = np.array([len(sweep.v) for sweep in sweeps])
+        n_samples = self.lengths.max()
+        self.v = np.full((len(sweeps), n_samples), np.nan, dtype=np.float32)
+        self.i = np.full((len(sweeps), n_samples), np.nan, dtype=np.float32)
+        for row, sweep in enumerate(sweeps):
+            self.v[row, :len(sweep.v)] = sweep.v
+            self.i[row, :len(sweep.i)] = sweep.i
+
+    def qc_mask(self):
+        """Return a boolean mask of sweeps whose recorded voltage and current
+        samples are all finite (NaN padding excluded)."""
+        n_finite = np.isfinite(self.v).sum(axis=1)
+        n_finite_i = np.isfinite(self.i).sum(axis=1)
+        return (n_finite == self.lengths) & (n_finite_i == self.lengths)
+
+
+def _has_qc_passed_recordings(session, db, cell):
+    """Return whether any current clamp recording on this cell's electrode
+    passed ephys QC, using a single DB query instead of parsing the NWB.
+    """
+    q = session.query(db.PatchClampRecording.id)
+    q = q.join(db.Recording, db.PatchClampRecording.recording)
+    q = q.filter(db.Recording.electrode_id == cell.electrode_id)
+    q = q.filter(db.PatchClampRecording.clamp_mode == 'ic')
+    # match get_intrinsic_recording_dict, which only skips qc_pass is False;
+    # recordings with no QC result (NULL) are still used
+    q = q.filter(db.PatchClampRecording.qc_pass.isnot(False))
+    return q.first() is not None
+
+
+# holding current amplitudes cached by stimulus identity; entries disappear
+# with their stimulus so the cache cannot outlive (or pin) the NWB objects
+_holding_amp_cache = weakref.WeakKeyDictionary()
+
+
+def _holding_amp(rec):
+    """Return the holding current amplitude for *rec*, or None if its stimulus
+    has no holding item.
+
+    The items list is scanned with an early-exit generator, and the result is
+    cached per stimulus object so repeated sweep construction from the same
+    recording does not re-scan the list.
+    """
+    stim = rec.stimulus
+    try:
+        return _holding_amp_cache[stim]
+    except (KeyError, TypeError):
+        pass
+    item = next((i for i in stim.items if i.description == 'holding current'), None)
+    amp = None if item is None else item.amplitude
+    try:
+        _holding_amp_cache[stim] = amp
+    except TypeError:
+        # stimulus is not weak-referenceable; skip caching
+        pass
+    return amp
+
+
+def _build_intrinsic_sweeps(recording_dict, cell_id=''):
+    """Build MPSweeps for the long square and chirp protocols in a single pass.
+
+    Recordings from both protocols are visited together in acquisition order,
+    so the NWB backend reads the file sequentially and its HDF5 chunk cache
+    stays hot, instead of the data being traversed once per protocol.
+
+    Returns (lp_sweeps, chirp_sweeps, min_pulse_dur, errors); *min_pulse_dur*
+    is None when no usable long pulse stimuli were found.
+    """
+    errors = []
+    lp_recs = recording_dict['LP']
+    chirp_recs = recording_dict['Chirp']
+
+    # probe long pulse times up front (this touches only stimulus metadata and
+    # command traces), so the duration reduction is a single vectorized pass
+    ptimes = []
+    for rec in lp_recs:
+        pulse_times = get_pulse_times(rec)
+        if pulse_times is not None:
+            ptimes.append((rec, pulse_times))
+
+    min_pulse_dur = None
+    lp_starts = {}
+    if len(lp_recs) > 0 and len(ptimes) == 0:
+        # without this check, no pulses would previously leave the inf
+        # sentinel in min_pulse_dur and silently analyze a nonsense window
+        errors.append('No long pulse stimuli found for cell %s' % cell_id)
+    elif len(ptimes) > 0:
+        durs = np.fromiter((end - start for rec, (start, end) in ptimes), dtype=np.float64, count=len(ptimes))
+        # drop only clearly degenerate pulses (e.g. truncated acquisition); LP
+        # protocols legitimately mix pulse durations (TargetV vs If_Curve), so
+        # anything within an order of magnitude of the longest pulse is kept and
+        # the smallest remaining duration becomes the analysis window
+        dur_ok = durs >= 0.1 * durs.max()
+        if not dur_ok.all():
+            errors.append('%d long square sweeps with degenerate pulse durations dropped for cell %s' % (int((~dur_ok).sum()), cell_id))
+        min_pulse_dur = durs[dur_ok].min()
+        lp_starts = {id(rec): start for (rec, (start, end)), ok in zip(ptimes, dur_ok) if ok}
+
+    # single pass over both protocols, tagged and in acquisition order
+    tagged = [('LP', rec) for rec in lp_recs if id(rec) in lp_starts]
+    tagged += [('Chirp', rec) for rec in chirp_recs]
+    tagged.sort(key=lambda item: item[1].parent.key)
+
+    lp_sweeps = []
+    chirp_sweeps = []
+    for protocol, rec in tagged:
+        # resolve the holding current here so sweep construction does not
+        # re-scan the stimulus items
+        holding = _holding_amp(rec)
+        if holding is None:
+            continue
+        if protocol == 'LP':
+            lp_sweeps.append(MPSweep(rec, -lp_starts[id(rec)], holding=holding))
+        else:
+            chirp_sweeps.append(MPSweep(rec, holding=holding))
+
+    return lp_sweeps, chirp_sweeps, min_pulse_dur, errors
+
+
+def _cell_intrinsic_features(expt, cell):
+    """Run long square and chirp feature extraction for one cell.
+
+    Returns (lp_results, chirp_results, errors).
+    """
+    dev_id = cell.electrode.device_id
+    recording_dict = get_intrinsic_recording_dict(expt, dev_id, check_qc=True)
+
+    # build sweeps for both protocols in one pass over the NWB
+    lp_sweeps, chirp_sweeps, min_pulse_dur, errors = _build_intrinsic_sweeps(recording_dict, cell_id=cell.id)
+
+    lp_results, error = IntrinsicPipelineModule.get_long_square_features(
+        recording_dict['LP'], cell_id=cell.id, sweeps=lp_sweeps, min_pulse_dur=min_pulse_dur)
+    errors += error
+    chirp_results, error = IntrinsicPipelineModule.get_chirp_features(
+        recording_dict['Chirp'], cell_id=cell.id, sweeps=chirp_sweeps)
+    errors += error
+    return lp_results, chirp_results, errors
+
+
+def _extract_cell_intrinsic(db_desc, job_id, cell_ext_id):
+    """Worker entry point for parallel intrinsic extraction; runs in a subprocess.
+
+    *db_desc* is (db_class, ro_host, rw_host, db_name); the database is
+    reconstructed here, and the experiment (and its NWB) re-opened lazily, so
+    that no unpicklable state needs to cross the process boundary.
+    """
+    db_class, ro_host, rw_host, db_name = db_desc
+    db = db_class(ro_host, rw_host, db_name)
+    session = db.session()
+    try:
+        expt = db.experiment_from_ext_id(job_id, session=session, preload=['cells'])
+        cell = expt.cells[cell_ext_id]
+        return _cell_intrinsic_features(expt, cell)
+    finally:
+        session.close()
+
+
+def _resample_traces(v, i, srate, target):
+    """Decimate *v* and *i* from *srate* to approximately *target* Hz.
+
+    Uses polyphase resampling (scipy.signal.resample_poly), which runs in one
+    upfirdn pass without the power-of-two padding and memory spike of
+    FFT-based resampling. Returns (v, i, new_srate).
+    """
+    frac = Fraction(target / srate).limit_denominator(1000)
+    up, down = frac.numerator, frac.denominator
+    v = scipy.signal.resample_poly(v, up, down)
+    i = scipy.signal.resample_poly(i, up, down)
+    return v, i, srate * up / down
+
+
+# pool of reusable (t, v, i) sweep buffers; without this, sweep construction
+# churns hundreds of MB per experiment through the allocator
+_sweep_buffer_pool = collections.deque()
+
+
+def _acquire_sweep_buffers(n):
+    """Return (t, v, i) arrays of length *n*, reusing a pooled buffer set when
+    one of sufficient capacity is available.
+
+    Voltage and current are float32: the traces are noisy biological signals
+    with well under 24 bits of information, and halving their width doubles
+    what fits in cache through the feature passes. The time base stays float64
+    because dv/dt computations difference it.
+    """
+    try:
+        bufs = _sweep_buffer_pool.pop()
+    except IndexError:
+        bufs = None
+    if bufs is None or len(bufs[0]) < n:
+        return np.empty(n), np.empty(n, dtype=np.float32), np.empty(n, dtype=np.float32)
+    return tuple(buf[:n] for buf in bufs)
+
+
+def _release_sweep_buffers(bufs):
+    """Return a (t, v, i) buffer set to the pool; buffers are stored at full
+    capacity so they can be re-sliced for any smaller sweep."""
+    _sweep_buffer_pool.append(tuple(buf if buf.base is None else buf.base for buf in bufs))
+
+
 try:
     class MPSweep(Sweep):
         """Adapter for neuroanalysis.Recording => ipfx.Sweep
         """
-        def __init__(self, rec, t0=0):
-            # pulses may have different start times, so we shift time values to make all pulses start at t=0
-            pri = rec['primary'].copy(t0=t0)
-            cmd = rec['command'].copy()
-            t = pri.time_values
-            v = pri.data * 1e3  # convert to mV
-            holding = [i for i in rec.stimulus.items if i.description=='holding current']
-            if len(holding) == 0:
-                # TODO: maybe log this error
-                return None
-            holding = holding[0].amplitude
-            i = (cmd.data - holding) * 1e12   # convert to pA with holding current removed
+        def __init__(self, rec, t0=0, primary=None, command=None, holding=None):
+            # pulses may have different start times, so we shift time values to make all pulses start at t=0.
+            # callers that have already resolved the recording's traces or holding
+            # current can pass them in to skip the item/property dispatch here.
+            pri = rec['primary'] if primary is None else primary
+            cmd = rec['command'] if command is None else command
+            if holding is None:
+                holding = _holding_amp(rec)
+                if holding is None:
+                    # TODO: maybe log this error
+                    return None
+
             srate = pri.sample_rate
+            v_src = pri.data
+            i_src = cmd.data
+            target = config.intrinsic_target_sample_rate
+            resampled = target is not None and srate > target
+            if resampled:
+                v_src, i_src, srate = _resample_traces(v_src, i_src, srate, target)
+
+            # neither trace is mutated here, so skip TSeries.copy() and write
+            # the converted values straight into pooled buffers; these arrays
+            # are megabytes per sweep
+            t, v, i = _acquire_sweep_buffers(len(v_src))
+            if resampled:
+                # regenerate the time base at the decimated rate
+                np.divide(np.arange(len(v_src)), srate, out=t)
+                t += t0
+            else:
+                np.add(pri.time_values, t0 - pri.t0, out=t)
+            np.multiply(v_src, 1e3, out=v)  # convert to mV
+            np.subtract(i_src, holding, out=i)
+            i *= 1e12   # convert to pA with holding current removed, in place
+            self._pooled_buffers = (t, v, i)
             sweep_num = rec.parent.key
             # modes 'ic' and 'vc' should be expanded
             clamp_mode = "CurrentClamp" if rec.clamp_mode=="ic" else "VoltageClamp" 
 
             Sweep.__init__(self, t, v, i, clamp_mode, srate, sweep_number=sweep_num)
+
+        def release(self):
+            """Return this sweep's arrays to the shared buffer pool.
+
+            Only call this once nothing else references the sweep data; the
+            buffers will be overwritten by subsequently constructed sweeps.
+            """
+            bufs = getattr(self, '_pooled_buffers', None)
+            if bufs is not None:
+                self._pooled_buffers = None
+                _release_sweep_buffers(bufs)
 except ImportError:
     pass
 
@@ -1,7 +1,8 @@
 # coding: utf8
 from __future__ import print_function, division
 
-import os, logging
+import os, logging, threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pyqtgraph as pg
 from collections import OrderedDict
@@ -39,17 +40,22 @@ class SynapsePipelineModule(MultipatchPipelineModule):
         db = job['database']
         expt_id = job['job_id']
         
-        expt = db.experiment_from_ext_id(expt_id, session=session)
+        # eager-load the pair/cell graph up front; the loops below touch
+        # pre/post cells for every pair and would otherwise fire N+1 queries
+        expt = db.experiment_from_ext_id(expt_id, session=session, preload=['cells', 'pairs'])
 
         # keep track of whether cells look like they should be inhibitory or excitatory based on synaptic projections
         synaptic_cell_class = {}
 
+        # first pass: record synapse calls from the notes db and collect the pairs
+        # that will need average-response fits
+        pair_notes = {}
         for pair in expt.pair_list:
             # look up synapse type from notes db
             notes_rec = notes_db.get_pair_notes_record(pair.experiment.ext_id, pair.pre_cell.ext_id, pair.post_cell.ext_id)
             if notes_rec is None:
                 continue
-            
+
             # update upstream pair record
             mono_synapse = notes_rec.notes['synapse_type'] in ('ex', 'in')
             pair.has_synapse = mono_synapse
@@ -57,10 +63,19 @@ class SynapsePipelineModule(MultipatchPipelineModule):
             pair.has_polysynapse = poly_synapse
             pair.has_electrical = notes_rec.notes['gap_junction']
 
-            
+            pair_notes[pair] = notes_rec
+
+        # fit averaged responses for all pairs that have a synapse; each pair's fit is
+        # independent, so this can optionally run across worker threads
+        fit_pairs = [pair for pair in pair_notes if pair.has_synapse or pair.has_polysynapse]
+        pair_fits = _fit_all_pairs(db, session, fit_pairs)
+
+        for pair, notes_rec in pair_notes.items():
             if pair.has_synapse:
-                errors = generate_synapse_record(pair, db, session, notes_rec, syn='mono', max_ind_freq=50)
-                
+                fits, fits_decay_20hz = pair_fits[pair.id]
+                errors = generate_synapse_record(pair, db, session, notes_rec, syn='mono', max_ind_freq=50,
+                                                 fits=fits, fits_decay_20hz=fits_decay_20hz)
+
                 all_errors.extend(errors)
 
                 pre_cell_class = notes_rec.notes['synapse_type']
@@ -91,7 +106,9 @@ class SynapsePipelineModule(MultipatchPipelineModule):
                     cell.cell_class, cell.cell_class_nonsynaptic = cell._infer_cell_classes()
 
             if pair.has_polysynapse:
-                errors = generate_synapse_record(pair, db, session, notes_rec, syn='poly', max_ind_freq=50)
+                fits, fits_decay_20hz = pair_fits[pair.id]
+                errors = generate_synapse_record(pair, db, session, notes_rec, syn='poly', max_ind_freq=50,
+                                                 fits=fits, fits_decay_20hz=fits_decay_20hz)
                 all_errors.extend(errors)
 
         session.commit()
@@ -148,7 +165,58 @@ class SynapsePipelineModule(MultipatchPipelineModule):
         return ready
 
 
-def generate_synapse_record(pair, db, session, notes_rec, syn='mono', max_ind_freq=50):
+# curve-fit parameters copied onto each avg_response_fit record
+FIT_KEYS = ('xoffset', 'yoffset', 'amp', 'rise_time', 'decay_tau', 'exp_amp', 'exp_tau')
+
+def _fit_pair(pair, session, notes_session=None):
+    """Compute average-response fits for one pair at both induction frequency limits.
+
+    Returns (pair.id, fits, fits_decay_20hz).
+    """
+    fits = get_pair_avg_fits(pair, session, notes_session=notes_session, max_ind_freq=50)
+    # for decay tau in IC mode we also use trains up to 20Hz
+    fits_decay_20hz = get_pair_avg_fits(pair, session, notes_session=notes_session, max_ind_freq=20)
+    return pair.id, fits, fits_decay_20hz
+
+
+def _fit_all_pairs(db, session, pairs):
+    """Return {pair.id: (fits, fits_decay_20hz)} for all *pairs*.
+
+    Serial fits run on the caller's *session*. If config.parallel_synapse_fits
+    is set, fits run in a thread pool instead (the least-squares fitting
+    releases the GIL inside numpy/lmfit); SQLAlchemy sessions are not
+    thread-safe, so each worker thread opens its own read-only sessions, all
+    of which are closed before returning. DB writes are left to the caller.
+    """
+    results = {}
+    if config.parallel_synapse_fits and len(pairs) > 1:
+        local = threading.local()
+        thread_sessions = []
+        lock = threading.Lock()
+
+        def fit_in_thread(pair):
+            if not hasattr(local, 'session'):
+                local.session = db.session()
+                local.notes_session = notes_db.db.session()
+                with lock:
+                    thread_sessions.extend([local.session, local.notes_session])
+            return _fit_pair(pair, local.session, local.notes_session)
+
+        try:
+            with ThreadPoolExecutor(max_workers=config.n_workers) as pool:
+                for pair_id, fits, fits_decay_20hz in pool.map(fit_in_thread, pairs):
+                    results[pair_id] = (fits, fits_decay_20hz)
+        finally:
+            for thread_session in thread_sessions:
+                thread_session.close()
+    else:
+        for pair in pairs:
+            pair_id, fits, fits_decay_20hz = _fit_pair(pair, session)
+            results[pair_id] = (fits, fits_decay_20hz)
+    return results
+
+
+def generate_synapse_record(pair, db, session, notes_rec, syn='mono', max_ind_freq=50, fits=None, fits_decay_20hz=None):
     """Generate synapse record and associated avg_response_fits.
     'syn' input denotes whether this is a mono- or poly-synaptic event"""
     logger = logging.getLogger(__name__)
@@ -174,8 +242,11 @@ def generate_synapse_record(pair, db, session, notes_rec, syn='mono', max_ind_fr
     #   - selected from <= 50Hz trains
     #   - must pass ex_qc_pass or in_qc_pass
     #   - must have exactly 1 pre spike with onset time
-    fits = get_pair_avg_fits(pair, session, max_ind_freq=max_ind_freq)
-    fits_decay_20hz = get_pair_avg_fits(pair, session, max_ind_freq=20)
+    # fits may be precomputed (possibly in worker threads) and passed in by the caller
+    if fits is None:
+        fits = get_pair_avg_fits(pair, session, max_ind_freq=max_ind_freq)
+    if fits_decay_20hz is None:
+        fits_decay_20hz = get_pair_avg_fits(pair, session, max_ind_freq=20)
     # This generates a structure like:
     # {(mode, holding): {
     #     'traces': , 
@@ -203,11 +274,15 @@ def generate_synapse_record(pair, db, session, notes_rec, syn='mono', max_ind_fr
             rise_vals[mode].append((fit['fit_result'].best_values['rise_time'], len(fit['responses']['qc_pass'])))
             decay_vals[mode].append((fit['fit_result'].best_values['decay_tau'], len(fit['responses']['qc_pass'])))
         
-        # record this fit in the avg_response_fit table
+        # record this fit in the avg_response_fit table; passing the fit
+        # parameters as constructor kwargs skips one instrumented
+        # __setattr__ dispatch per parameter per record
+        fit_params = fit['fit_result'].best_values
         rec = db.AvgResponseFit(
             clamp_mode=mode,
             holding=holding,
             nrmse=fit['fit_result'].nrmse(),
+            **{'fit_' + k: fit_params[k] for k in FIT_KEYS},
             initial_xoffset=fit['initial_latency'],
             manual_qc_pass=fit['fit_qc_pass'],
             avg_data=fit['average'].data,
@@ -226,9 +301,6 @@ def generate_synapse_record(pair, db, session, notes_rec, syn='mono', max_ind_fr
             rec.meta = {'fit_qc_pass_reasons': reasons}
             errors.append("Fit errors for %s %s %s: %s" % (pair.experiment.ext_id, pair.pre_cell.ext_id, pair.post_cell.ext_id, '\n'.join(reasons)))
 
-        for k in ['xoffset', 'yoffset', 'amp', 'rise_time', 'decay_tau', 'exp_amp', 'exp_tau']:
-            setattr(rec, 'fit_'+k, fit['fit_result'].best_values[k])
-
         # for decay tau in IC mode we also use trains up to 20Hz, note these are not qc'ed
         if mode == 'ic':
             fit_decay = fits_decay_20hz[(mode, holding)]
@@ -0,0 +1,103 @@
+# coding: utf8
+"""
+Optional numba acceleration for ipfx spike-detection inner loops.
+
+ipfx locates spike peaks, upstrokes, and thresholds with per-spike Python
+loops (argmax over a slice per spike, a backward scalar walk per threshold).
+On sweeps with many spikes this cost is interpreter dispatch, not numeric
+work. When numba is importable, install() replaces those
+ipfx.spike_detector helpers with thin wrappers around @njit kernels that have
+identical semantics; importing this module without numba (or ipfx) raises
+ImportError and the caller falls back to the stock ipfx path.
+"""
+import numpy as np
+
+from numba import njit
+import ipfx.spike_detector
+from ipfx import time_series_utils as tsu
+
+
+@njit(cache=True)
+def _segment_argmax(x, starts, ends):
+    out = np.empty(len(starts), dtype=np.int64)
+    for i in range(len(starts)):
+        s = starts[i]
+        best = s
+        best_val = x[s]
+        for j in range(s + 1, ends[i]):
+            if x[j] > best_val:
+                best_val = x[j]
+                best = j
+        out[i] = best
+    return out
+
+
+@njit(cache=True)
+def _refine_thresholds(dvdt, upstroke_indexes, target):
+    # walk backward from each upstroke until dvdt drops to the target fraction;
+    # like stock ipfx, fall back to the start of the search interval (the
+    # previous upstroke, or 0 for the first spike) when no crossing is found
+    out = np.empty(len(upstroke_indexes), dtype=np.int64)
+    prev = 0
+    for i in range(len(upstroke_indexes)):
+        upstk = upstroke_indexes[i]
+        out[i] = prev
+        for j in range(upstk, prev, -1):
+            if dvdt[j] <= target:
+                out[i] = j
+                break
+        prev = upstk
+    return out
+
+
+def find_peak_indexes(v, t, spike_indexes, end=None):
+    """numba-backed equivalent of ipfx.spike_detector.find_peak_indexes."""
+    if end is None:
+        end = t[-1]
+    end_index = tsu.find_time_index(t, end)
+
+    spks = np.append(spike_indexes, end_index)
+    starts = np.asarray(spks[:-1], dtype=np.int64)
+    ends = np.asarray(spks[1:], dtype=np.int64)
+    return _segment_argmax(np.asarray(v, dtype=np.float64), starts, ends)
+
+
+def find_upstroke_indexes(v, t, spike_indexes, peak_indexes, filter=10., dvdt=None):
+    """numba-backed equivalent of ipfx.spike_detector.find_upstroke_indexes."""
+    if dvdt is None:
+        dvdt = tsu.calculate_dvdt(v, t, filter)
+
+    starts = np.asarray(spike_indexes, dtype=np.int64)
+    ends = np.asarray(peak_indexes, dtype=np.int64)
+    return _segment_argmax(np.asarray(dvdt, dtype=np.float64), starts, ends)
+
+
+def refine_threshold_indexes(v, t, upstroke_indexes, thresh_frac=0.05, filter=10., dvdt=None):
+    """numba-backed equivalent of ipfx.spike_detector.refine_threshold_indexes."""
+    if not upstroke_indexes.size:
+        return np.array([])
+    if dvdt is None:
+        dvdt = tsu.calculate_dvdt(v, t, filter)
+
+    avg_upstroke = dvdt[upstroke_indexes].mean()
+    target = avg_upstroke * thresh_frac
+    return _refine_thresholds(np.asarray(dvdt, dtype=np.float64),
+                              np.asarray(upstroke_indexes, dtype=np.int64), target)
+
+
+_replacements = {
+    'find_peak_indexes': find_peak_indexes,
+    'find_upstroke_indexes': find_upstroke_indexes,
+    'refine_threshold_indexes': refine_threshold_indexes,
+}
+
+
+def install():
+    """Patch the jitted helpers into ipfx.spike_detector.
+
+    Only helpers that exist in the installed ipfx are replaced, so version
+    differences degrade to the stock implementation rather than breaking.
+    """
+    for name, func in _replacements.items():
+        if hasattr(ipfx.spike_detector, name):
+            setattr(ipfx.spike_detector, name, func)
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+scipy_fft = pytest.importorskip('scipy.fft')
+chirp_features = pytest.importorskip('aisynphys.chirp_features')
+
+
+class MockSweep(object):
+    def __init__(self, v, i, sampling_rate):
+        self.v = v
+        self.i = i
+        self.sampling_rate = sampling_rate
+
+
+class MockSweepSet(object):
+    def __init__(self, sweeps):
+        self.sweeps = sweeps
+
+
+# band-pass "membrane": Z(f) = R * (j f / (f0 Q)) / (1 - (f/f0)^2 + j f / (f0 Q)).
+# |Z| peaks at exactly f0 with value R; the upper -3dB point is at
+# f0 * (1/(2Q) + sqrt(1 + 1/(4Q^2))); the phase is positive (inductive) below
+# f0 and crosses zero at f0.
+R = 150.   # MOhm
+F0 = 10.   # Hz
+Q = 1.
+
+
+def impedance(freq):
+    u = freq / F0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = R * (1j * u / Q) / (1 - u ** 2 + 1j * u / Q)
+    z[freq == 0] = 0
+    return z
+
+
+def resonant_chirp_sweep():
+    """Return a sweep whose response is the chirp stimulus passed through the
+    band-pass impedance above, so every extracted feature is known analytically.
+    """
+    sample_rate = 1000.
+    duration = 20.
+    t = np.arange(0, duration, 1. / sample_rate)
+    f_start, f_end = 0.2, 40.
+    i = 20 * np.sin(2 * np.pi * (f_start * t + (f_end - f_start) / (2 * duration) * t ** 2))
+
+    # 20000 samples is already 5-smooth, so the extractor's nfft matches and
+    # the response is exact on every frequency bin
+    assert scipy_fft.next_fast_len(len(t)) == len(t)
+    freq = scipy_fft.rfftfreq(len(t), d=1. / sample_rate)
+    v = scipy_fft.irfft(impedance(freq) * scipy_fft.rfft(i), n=len(t))
+    return MockSweep(v, i, sample_rate)
+
+
+def test_extract_chirp_fft():
+    sweep_set = MockSweepSet([resonant_chirp_sweep(), resonant_chirp_sweep()])
+    features = chirp_features.extract_chirp_fft(sweep_set)
+
+    # F0 falls exactly on the 0.05 Hz frequency grid
+    assert features['peak_freq'] == pytest.approx(F0, abs=0.05)
+    assert features['peak_impedance'] == pytest.approx(R, rel=1e-3)
+
+    # upper -3dB point of the band-pass, within one frequency bin
+    f_3db = F0 * (1 / (2 * Q) + np.sqrt(1 + 1 / (4 * Q ** 2)))
+    assert features['3db_freq'] == pytest.approx(f_3db, abs=0.1)
+
+    # phase crosses zero exactly at the resonant frequency
+    assert features['sync_freq'] == pytest.approx(F0, abs=0.05)
+
+    # resonance relative to the impedance at the lowest analyzed frequency
+    expected_ratio = R / np.abs(impedance(np.array([0.2])))[0]
+    assert features['peak_ratio'] == pytest.approx(expected_ratio, rel=1e-2)
+
+    # the leading phase below resonance integrates to a positive area
+    assert features['total_inductive_phase'] > 0
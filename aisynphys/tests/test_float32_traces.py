@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+spkd = pytest.importorskip('ipfx.spike_detector')
+tsu = pytest.importorskip('ipfx.time_series_utils')
+
+# Intrinsic sweeps store voltage and current as float32 (the time base stays
+# float64); spike features extracted from them must match the float64 result
+# to well under 1e-5 relative.
+
+
+def synthetic_spiking_sweep():
+    """Return (v, t) for a smooth trace with several synthetic action potentials."""
+    sample_rate = 50000.
+    t = np.arange(0, 0.5, 1. / sample_rate)
+    v = np.full(t.shape, -70.)
+    for spike_time in (0.1, 0.18, 0.27, 0.35, 0.42):
+        v += 100 * np.exp(-(t - spike_time) ** 2 / (2 * 0.0004 ** 2))
+        v -= 8 * np.exp(-(t - spike_time - 0.002) ** 2 / (2 * 0.002 ** 2))
+    return v, t
+
+
+def spike_features(v, t):
+    """Return (spike sample indexes, feature value array) extracted from *v*.
+
+    *v* is passed to ipfx at its own precision, the same way MPSweep feeds
+    float32 traces to the analysis in production.
+    """
+    spike_indexes = spkd.detect_putative_spikes(v, t)
+    peak_indexes = spkd.find_peak_indexes(v, t, spike_indexes)
+    upstroke_indexes = spkd.find_upstroke_indexes(v, t, spike_indexes, peak_indexes)
+    threshold_indexes = spkd.refine_threshold_indexes(v, t, upstroke_indexes)
+    dvdt = tsu.calculate_dvdt(v, t, filter=10.)
+    indexes = np.concatenate([spike_indexes, peak_indexes, upstroke_indexes, threshold_indexes])
+    values = np.concatenate([v[peak_indexes], v[threshold_indexes], dvdt[upstroke_indexes]])
+    return indexes, values
+
+
+def test_spike_features_float32():
+    v, t = synthetic_spiking_sweep()
+    indexes_64, values_64 = spike_features(v, t)
+    indexes_32, values_32 = spike_features(v.astype(np.float32), t)
+
+    assert len(indexes_64) > 0
+    np.testing.assert_array_equal(indexes_32, indexes_64)
+    np.testing.assert_allclose(values_32, values_64, rtol=1e-5)
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+spkd = pytest.importorskip('ipfx.spike_detector')
+spike_jit = pytest.importorskip('aisynphys.spike_jit')
+
+
+def synthetic_spiking_trace():
+    """Return (v, t) for a noisy trace with several synthetic action potentials."""
+    sample_rate = 50000.
+    t = np.arange(0, 0.5, 1. / sample_rate)
+    v = np.full(t.shape, -70.)
+    for spike_time in (0.1, 0.18, 0.27, 0.35, 0.42):
+        # fast gaussian upstroke followed by a slower repolarization
+        v += 100 * np.exp(-(t - spike_time) ** 2 / (2 * 0.0004 ** 2))
+        v -= 8 * np.exp(-(t - spike_time - 0.002) ** 2 / (2 * 0.002 ** 2))
+    rng = np.random.RandomState(0)
+    v += rng.normal(scale=0.05, size=t.shape)
+    return v, t
+
+
+def test_jit_matches_ipfx():
+    """The jitted wrappers must return exactly the same indexes as stock ipfx."""
+    v, t = synthetic_spiking_trace()
+    spike_indexes = spkd.detect_putative_spikes(v, t)
+    assert spike_indexes.size == 5
+
+    peaks_ref = spkd.find_peak_indexes(v, t, spike_indexes)
+    peaks_jit = spike_jit.find_peak_indexes(v, t, spike_indexes)
+    np.testing.assert_array_equal(peaks_jit, peaks_ref)
+
+    upstrokes_ref = spkd.find_upstroke_indexes(v, t, spike_indexes, peaks_ref)
+    upstrokes_jit = spike_jit.find_upstroke_indexes(v, t, spike_indexes, peaks_ref)
+    np.testing.assert_array_equal(upstrokes_jit, upstrokes_ref)
+
+    thresholds_ref = spkd.refine_threshold_indexes(v, t, upstrokes_ref)
+    thresholds_jit = spike_jit.refine_threshold_indexes(v, t, upstrokes_ref)
+    np.testing.assert_array_equal(thresholds_jit, thresholds_ref)
+    # must be usable directly as an index array, e.g. t[threshold_indexes]
+    assert np.issubdtype(np.asarray(thresholds_jit).dtype, np.integer)
+
+
+def test_refine_threshold_fallback():
+    """When dvdt never drops below the target, fall back to the interval start
+    (like stock ipfx) rather than producing a non-index value."""
+    dvdt = np.full(100, 50.)
+    upstrokes = np.array([30, 60], dtype=np.int64)
+    out = spike_jit._refine_thresholds(dvdt, upstrokes, 1.0)
+    np.testing.assert_array_equal(out, [0, 30])